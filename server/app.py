@@ -1,15 +1,46 @@
 # server/app.py
 
-from flask import Flask, request, jsonify
+import os
+import pathlib
+import sqlite3
+import threading
+
+from flask import Flask, request, abort, stream_with_context
 from flask_migrate import Migrate
+from sqlalchemy import (bindparam, create_engine, delete, event, insert,
+                        lambda_stmt, or_, select, text, update)
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import QueuePool
 
-from models import db, Pet
+import fastjson
+from models import db, Pet, pets_version
 
 # create a Flask application instance 
 app = Flask(__name__)
 
-# configure the database connection to the local file app.db
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
+# number of worker threads used by the production server
+SERVER_THREADS = 8
+
+
+def is_sqlite_memory(url):
+    """Return True if url points at an in-memory SQLite database"""
+    return url.get_backend_name() == 'sqlite' and \
+        url.database in (None, '', ':memory:')
+
+
+# configure the database connection to the local file app.db, unless
+# DATABASE_URI points somewhere else (the tests use an in-memory database)
+DATABASE_URI = os.environ.get('DATABASE_URI', 'sqlite:///app.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+# keep one pooled connection per waitress thread; servers with more
+# threads, such as flask run, open extra connections instead of waiting for
+# one to free up. In-memory databases share a single connection and don't
+# accept pool sizing options
+POOL_OPTIONS = {'pool_size': SERVER_THREADS, 'max_overflow': -1}
+if not is_sqlite_memory(make_url(DATABASE_URI)):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(POOL_OPTIONS)
 
 # configure flag to disable modification tracking and use less memory
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -20,9 +51,162 @@ migrate = Migrate(app, db)
 # initialize the Flask application to use the database
 db.init_app(app)
 
+
+# read database pages through a memory map of up to this many bytes
+# instead of read() calls
+MMAP_SIZE = 256 * 1024 * 1024
+
+
+# configure SQLite on each new connection; pooled connections are reused,
+# so this runs once per connection rather than once per request
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Use WAL so readers are not blocked by writers, with fewer fsyncs"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+    cursor.close()
+
+
+def set_reader_pragmas(dbapi_connection, connection_record):
+    """Wait for locks instead of failing immediately on read connections"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+    cursor.close()
+
+
+# SQLite allows a single writer at a time, so writes are serialized here
+# rather than failing with SQLITE_BUSY
+write_lock = threading.Lock()
+
+
+def create_read_engine(path):
+    """Return an engine with a pool of read-only connections to path"""
+    # as_uri() percent-encodes characters such as '#', '?' and '%' that
+    # would otherwise be read as part of the SQLite URI syntax
+    uri = pathlib.Path(path).resolve().as_uri() + '?mode=ro'
+    engine = create_engine(
+        'sqlite://',
+        creator=lambda: sqlite3.connect(
+            uri, uri=True, check_same_thread=False),
+        poolclass=QueuePool,
+        **POOL_OPTIONS,
+    )
+    event.listen(engine, 'connect', set_reader_pragmas)
+    return engine
+
+
+def ensure_indexes(bind):
+    """Create declared indexes missing from tables that already existed"""
+    # create_all() skips existing tables entirely, including their indexes
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind, checkfirst=True)
+
+
 # Create all tables
 with app.app_context():
+    # the pets_version triggers, PRAGMAs and read-only engine are SQLite
+    # specific; other databases run without them
+    IS_SQLITE = db.engine.url.get_backend_name() == 'sqlite'
+    # in-memory databases cannot use WAL, so only file databases get the
+    # pragmas and a separate pool of read-only connections
+    if IS_SQLITE and not is_sqlite_memory(db.engine.url):
+        event.listen(db.engine, 'connect', set_sqlite_pragmas)
+        read_engine = create_read_engine(db.engine.url.database)
+    else:
+        read_engine = db.engine
     db.create_all()
+    ensure_indexes(db.engine)
+
+# route read queries to the read-only engine
+READ_ONLY = {'bind': read_engine}
+
+
+# how often to refresh the query planner statistics, in seconds
+OPTIMIZE_INTERVAL = 15 * 60
+
+
+def optimize_database():
+    """Run PRAGMA optimize so the query planner statistics stay fresh"""
+    # PRAGMA optimize may write sqlite_stat1, so it counts as a write
+    with write_lock, app.app_context():
+        db.session.execute(text('PRAGMA optimize'))
+        db.session.commit()
+
+
+def schedule_optimize():
+    """Run optimize_database now and then every OPTIMIZE_INTERVAL seconds"""
+    try:
+        optimize_database()
+    except SQLAlchemyError:
+        # a failed run (e.g. the database stayed locked) is retried on the
+        # next interval rather than stopping the schedule or the server
+        app.logger.exception('PRAGMA optimize failed')
+    finally:
+        timer = threading.Timer(OPTIMIZE_INTERVAL, schedule_optimize)
+        timer.daemon = True
+        timer.start()
+
+
+# JSON helpers backed by fastjson, which uses orjson when it is installed
+# and is considerably faster than the stdlib json encoder that jsonify uses
+
+def json_response(body, status=200):
+    """Wrap already serialized JSON bytes in a response"""
+    # Werkzeug sets Content-Length from the bytes body; direct_passthrough
+    # hands the body to the server without adapting the iterable again
+    response = app.response_class(body, status=status,
+                                  mimetype='application/json')
+    response.direct_passthrough = True
+    return response
+
+
+def ojsonify(obj, status=200):
+    """Serialize obj with fastjson and wrap it in a JSON response"""
+    return json_response(fastjson.dumps(obj), status)
+
+
+def get_json_body():
+    """Parse the request body with fastjson, aborting with 400 if invalid"""
+    try:
+        return fastjson.loads(request.get_data())
+    except ValueError:
+        abort(400)
+
+
+# number of rows fetched and serialized at a time when listing pets
+STREAM_BATCH_SIZE = 500
+
+# error bodies never change, so serialize them once up front
+NOT_FOUND = fastjson.dumps({'error': 'Pet not found'})
+MISSING_FIELDS = fastjson.dumps({'error': 'Name and species are required'})
+NOT_AN_OBJECT = fastjson.dumps({'error': 'Request body must be a JSON object'})
+
+# cached statement for looking up a single pet by its id
+GET_PET = lambda_stmt(lambda: select(Pet).where(Pet.id == bindparam('pid')))
+
+
+def find_pet(pet_id, bind_arguments=None):
+    """Return the pet with the given id, or None if it doesn't exist"""
+    return db.session.execute(
+        GET_PET, {'pid': pet_id}, bind_arguments=bind_arguments
+    ).scalar_one_or_none()
+
+
+def format_pet(pet_id, name, species):
+    """Serialize a single pet without building an intermediate dict"""
+    return b'{"id":%d,"name":%s,"species":%s}' % (
+        pet_id, fastjson.dumps(name), fastjson.dumps(species))
+
+
+def pet_dicts(rows):
+    """Convert (id, name, species) rows into dicts ready for serialization"""
+    # unpacking plain row tuples is much cheaper than dict(RowMapping)
+    return [{'id': pet_id, 'name': name, 'species': species}
+            for pet_id, name, species in rows]
 
 
 # CRUD Routes
@@ -30,22 +214,21 @@ with app.app_context():
 @app.route('/pets', methods=['POST'])
 def create_pet():
     """Create a new pet"""
-    data = request.get_json()
+    data = get_json_body()
     
     # Validate required fields
     if not data or not data.get('name') or not data.get('species'):
-        return jsonify({'error': 'Name and species are required'}), 400
+        return json_response(MISSING_FIELDS, 400)
     
-    # Create new pet
-    pet = Pet(name=data['name'], species=data['species'])
-    db.session.add(pet)
-    db.session.commit()
+    # Create new pet, reading back the stored row in the same statement
+    stmt = insert(Pet).values(
+        name=data['name'], species=data['species']
+    ).returning(Pet.id, Pet.name, Pet.species)
+    with write_lock:
+        row = db.session.execute(stmt).one()
+        db.session.commit()
     
-    return jsonify({
-        'id': pet.id,
-        'name': pet.name,
-        'species': pet.species
-    }), 201
+    return json_response(format_pet(*row), 201)
 
 
 @app.route('/pets', methods=['GET'])
@@ -54,72 +237,123 @@ def get_pets():
     # Get query parameters for filtering
     species_filter = request.args.get('species')
     
-    # Build query
-    query = Pet.query
+    # the URL already distinguishes filters, so the ETag only needs to
+    # change when the data does; it is read before the list, so a write in
+    # between can only make the tag older than the data, never newer
+    etag = None
+    if IS_SQLITE:
+        token, version = db.session.execute(
+            select(pets_version.c.token, pets_version.c.version),
+            bind_arguments=READ_ONLY,
+        ).one()
+        etag = f'{token}-{version}'
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+    
+    # Build query selecting only the columns we return, which avoids
+    # loading full Pet objects into the session
+    stmt = select(Pet.id, Pet.name, Pet.species)
     if species_filter:
-        query = query.filter_by(species=species_filter)
+        stmt = stmt.where(Pet.species == species_filter)
+    
+    result = db.session.execute(
+        stmt.execution_options(yield_per=STREAM_BATCH_SIZE),
+        bind_arguments=READ_ONLY,
+    )
     
-    pets = query.all()
+    # stream the JSON array one batch of rows at a time, so memory use
+    # depends on the batch size rather than the size of the table
+    def generate():
+        yield b'['
+        separator = b''
+        for batch in result.partitions():
+            yield separator
+            # serialize the batch as a list, then drop its brackets
+            yield fastjson.dumps(pet_dicts(batch))[1:-1]
+            separator = b','
+        yield b']'
     
-    return jsonify([{
-        'id': pet.id,
-        'name': pet.name,
-        'species': pet.species
-    } for pet in pets])
+    response = app.response_class(stream_with_context(generate()),
+                                  mimetype='application/json')
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
 
 
 @app.route('/pets/<int:pet_id>', methods=['GET'])
 def get_pet(pet_id):
     """Get a specific pet by ID"""
-    pet = db.session.get(Pet, pet_id)
+    pet = find_pet(pet_id, READ_ONLY)
     
     if pet is None:
-        return jsonify({'error': 'Pet not found'}), 404
+        return json_response(NOT_FOUND, 404)
     
-    return jsonify({
-        'id': pet.id,
-        'name': pet.name,
-        'species': pet.species
-    })
+    return json_response(format_pet(pet.id, pet.name, pet.species))
 
 
 @app.route('/pets/<int:pet_id>', methods=['PUT', 'PATCH'])
 def update_pet(pet_id):
     """Update a pet"""
-    pet = db.session.get(Pet, pet_id)
+    data = get_json_body()
     
-    if pet is None:
-        return jsonify({'error': 'Pet not found'}), 404
-    
-    data = request.get_json()
+    if not isinstance(data, dict):
+        return json_response(NOT_AN_OBJECT, 400)
     
     # Update fields if provided
-    if 'name' in data:
-        pet.name = data['name']
-    if 'species' in data:
-        pet.species = data['species']
+    values = {field: data[field] for field in ('name', 'species')
+              if field in data}
+    
+    if values:
+        with write_lock:
+            # only touch the row when a value actually differs, returning
+            # the updated pet from the same statement
+            stmt = update(Pet).where(
+                Pet.id == pet_id,
+                or_(*(getattr(Pet, field).is_distinct_from(value)
+                      for field, value in values.items())),
+            ).values(**values).returning(Pet.id, Pet.name, Pet.species)
+            row = db.session.execute(
+                stmt, execution_options={'synchronize_session': False}
+            ).first()
+            if row is not None:
+                db.session.commit()
+                return json_response(format_pet(*row))
+            
+            # even an UPDATE matching no rows takes SQLite's write lock, so
+            # release it before giving up write_lock
+            db.session.rollback()
+    
+    # either the pet does not exist or nothing changed, and neither needs
+    # a commit
+    pet = find_pet(pet_id, READ_ONLY)
     
-    db.session.commit()
+    if pet is None:
+        return json_response(NOT_FOUND, 404)
     
-    return jsonify({
-        'id': pet.id,
-        'name': pet.name,
-        'species': pet.species
-    })
+    return json_response(format_pet(pet.id, pet.name, pet.species))
 
 
 @app.route('/pets/<int:pet_id>', methods=['DELETE'])
 def delete_pet(pet_id):
     """Delete a pet"""
-    pet = db.session.get(Pet, pet_id)
-    
-    if pet is None:
-        return jsonify({'error': 'Pet not found'}), 404
+    # delete and confirm the pet existed in a single statement
+    stmt = delete(Pet).where(Pet.id == pet_id).returning(Pet.id)
     
-    db.session.delete(pet)
-    db.session.commit()
+    with write_lock:
+        row = db.session.execute(
+            stmt, execution_options={'synchronize_session': False}
+        ).first()
+        
+        if row is None:
+            # release the write lock taken by the DELETE
+            db.session.rollback()
+            return json_response(NOT_FOUND, 404)
+        
+        db.session.commit()
     
-    return jsonify({'message': 'Pet deleted successfully'}), 200
+    return ojsonify({'message': 'Pet deleted successfully'}, 200)
 
 
 # Flask shell context for easy database operations
@@ -129,4 +363,13 @@ def make_shell_context():
 
 
 if __name__ == '__main__':
-    app.run(port=5555, debug=True)
+    if IS_SQLITE:
+        schedule_optimize()
+    # app.debug is parsed from FLASK_DEBUG by Flask, so '0' and 'false'
+    # count as off
+    if app.debug:
+        # single-threaded development server with the reloader
+        app.run(port=5555, debug=True)
+    else:
+        from waitress import serve
+        serve(app, host='127.0.0.1', port=5555, threads=SERVER_THREADS)
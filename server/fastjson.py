@@ -0,0 +1,27 @@
+# server/fastjson.py
+
+# JSON encoding with the fastest library available: orjson, then ujson, then
+# the standard library. dumps always returns bytes and loads accepts bytes,
+# whichever implementation is in use.
+
+try:
+    import orjson
+
+    dumps = orjson.dumps
+    loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+
+        def dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False).encode()
+
+        loads = ujson.loads
+    except ImportError:
+        import json
+
+        def dumps(obj):
+            return json.dumps(
+                obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+        loads = json.loads
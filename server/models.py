@@ -1,5 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import MetaData
+from sqlalchemy import DDL, MetaData, event
 
 # contains definitions of tables and associated schema constructs
 metadata = MetaData()
@@ -12,6 +12,11 @@ db = SQLAlchemy(metadata=metadata)
 
 class Pet(db.Model):
     __tablename__ = 'pets'
+    # covers the species filter in GET /pets; id is the rowid, so every
+    # index already includes it
+    __table_args__ = (
+        db.Index('ix_pets_species_name', 'species', 'name'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
@@ -19,3 +24,28 @@ class Pet(db.Model):
 
     def __repr__(self):
         return f'<Pet {self.id}, {self.name}, {self.species}>'
+
+
+# single-row table holding a counter that triggers bump on every change to
+# pets, so any writer (the API, flask shell, another process) invalidates
+# the GET /pets ETag; token changes if the database is recreated. The row
+# and triggers use SQLite syntax, so other databases only get the table
+# and GET /pets sends no ETag there
+pets_version = db.Table(
+    'pets_version',
+    db.Column('token', db.String, nullable=False),
+    db.Column('version', db.Integer, nullable=False),
+)
+# the triggers reference pets, so it has to be created first
+pets_version.add_is_dependent_on(Pet.__table__)
+
+event.listen(pets_version, 'after_create', DDL(
+    "INSERT INTO pets_version (token, version) "
+    "VALUES (lower(hex(randomblob(8))), 0)"
+).execute_if(dialect='sqlite'))
+for operation in ('INSERT', 'UPDATE', 'DELETE'):
+    event.listen(pets_version, 'after_create', DDL(
+        f"CREATE TRIGGER pets_version_{operation.lower()} "
+        f"AFTER {operation} ON pets "
+        "BEGIN UPDATE pets_version SET version = version + 1; END"
+    ).execute_if(dialect='sqlite'))
@@ -1,45 +1,61 @@
 
 import pytest
-import json
+import importlib.util
 import os
-import tempfile
+import sqlite3
+import sys
+
+# Use a single in-memory database for the whole test session; this must be
+# set before the app is imported since the engine is created at import time
+os.environ['DATABASE_URI'] = 'sqlite://'
+
+import app as app_module
+import fastjson
 from app import app, db
+from fastjson import loads
 from models import Pet
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import OperationalError
+
+
+# set whenever a transaction is committed, so tests that never write to the
+# database can skip the reset
+_db_state = {'dirty': False}
+
+
+def _mark_dirty(conn):
+    _db_state['dirty'] = True
+
+
+@pytest.fixture(scope='session', autouse=True)
+def setup_database():
+    """Create the schema once for the whole test session"""
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        event.listen(db.engine, 'commit', _mark_dirty)
 
 
 @pytest.fixture
 def client():
     """Create a test client for the Flask app"""
-    # Create a temporary database file
-    db_fd, db_path = tempfile.mkstemp()
-    
-    # Configure the app for testing
-    app.config['TESTING'] = True
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    
     with app.test_client() as client:
-        # Create all tables
-        with app.app_context():
-            db.create_all()
-            # Start with clean session
-            db.session.rollback()
         yield client
-        # Clean up database and session
+        # Clean up session
         with app.app_context():
             db.session.rollback()
-        # Clean up file
-        os.close(db_fd)
-        os.unlink(db_path)
 
 
 @pytest.fixture(autouse=True)
 def reset_database():
     """Reset database after each test to ensure isolation"""
     yield
+    if not _db_state['dirty']:
+        return
     with app.app_context():
-        db.drop_all()
-        db.create_all()
+        db.session.execute(text('DELETE FROM pets'))
+        db.session.commit()
+    _db_state['dirty'] = False
 
 
 @pytest.fixture
@@ -52,6 +68,20 @@ def sample_pets():
     ]
 
 
+def _j(response):
+    """Parse a response body as JSON"""
+    return loads(response.data)
+
+
+def _seed(pets):
+    """Bulk insert pets in a single transaction and return their ids"""
+    mappings = [dict(pet) for pet in pets]
+    with app.app_context():
+        db.session.bulk_insert_mappings(Pet, mappings, return_defaults=True)
+        db.session.commit()
+    return [mapping['id'] for mapping in mappings]
+
+
 class TestPetCreation:
     """Test pet creation operations"""
     
@@ -62,7 +92,7 @@ class TestPetCreation:
                              content_type='application/json')
         
         assert response.status_code == 201
-        data = json.loads(response.data)
+        data = _j(response)
         assert data['name'] == 'Fido'
         assert data['species'] == 'Dog'
         assert 'id' in data
@@ -75,7 +105,7 @@ class TestPetCreation:
                              content_type='application/json')
         
         assert response.status_code == 400
-        data = json.loads(response.data)
+        data = _j(response)
         assert 'error' in data
         assert 'Name and species are required' in data['error']
     
@@ -86,7 +116,7 @@ class TestPetCreation:
                              content_type='application/json')
         
         assert response.status_code == 400
-        data = json.loads(response.data)
+        data = _j(response)
         assert 'error' in data
         assert 'Name and species are required' in data['error']
     
@@ -97,7 +127,7 @@ class TestPetCreation:
                              content_type='application/json')
         
         assert response.status_code == 400
-        data = json.loads(response.data)
+        data = _j(response)
         assert 'error' in data
 
 
@@ -109,18 +139,17 @@ class TestPetReading:
         response = client.get('/pets')
         
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = _j(response)
         assert data == []
     
     def test_get_all_pets_with_data(self, client, sample_pets):
         """Test getting all pets when database has data"""
         # Create pets first
-        for pet_data in sample_pets:
-            client.post('/pets', json=pet_data, content_type='application/json')
+        _seed(sample_pets)
         
         response = client.get('/pets')
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = _j(response)
         assert len(data) == 3
         
         # Check first pet
@@ -134,15 +163,12 @@ class TestPetReading:
     def test_get_pet_by_id_success(self, client, sample_pets):
         """Test getting a specific pet by ID"""
         # Create a pet first
-        create_response = client.post('/pets', 
-                                    json=sample_pets[0], 
-                                    content_type='application/json')
-        pet_id = json.loads(create_response.data)['id']
+        pet_id = _seed(sample_pets[:1])[0]
         
         # Get the pet
         response = client.get(f'/pets/{pet_id}')
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = _j(response)
         assert data['name'] == 'Fido'
         assert data['species'] == 'Dog'
         assert data['id'] == pet_id
@@ -151,23 +177,56 @@ class TestPetReading:
         """Test getting a pet that doesn't exist"""
         response = client.get('/pets/999')
         assert response.status_code == 404
-        data = json.loads(response.data)
+        data = _j(response)
         assert 'error' in data
         assert 'Pet not found' in data['error']
     
     def test_get_pets_filter_by_species(self, client, sample_pets):
         """Test filtering pets by species"""
         # Create pets
-        for pet_data in sample_pets:
-            client.post('/pets', json=pet_data, content_type='application/json')
+        _seed(sample_pets)
         
         # Filter by species
         response = client.get('/pets?species=Cat')
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = _j(response)
         assert len(data) == 1
         assert data[0]['name'] == 'Whiskers'
         assert data[0]['species'] == 'Cat'
+    
+    def test_get_all_pets_not_modified(self, client, sample_pets):
+        """Test revalidating the pet list with its ETag"""
+        response = client.get('/pets')
+        assert _j(response) == []
+        etag = response.headers['ETag']
+        
+        # Unchanged data answers with 304 and no body
+        response = client.get('/pets', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+        
+        # A write through the API invalidates the ETag
+        client.post('/pets', json=sample_pets[0],
+                    content_type='application/json')
+        response = client.get('/pets', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert len(_j(response)) == 1
+        assert response.headers['ETag'] != etag
+    
+    def test_get_all_pets_not_modified_after_shell_write(self, client):
+        """Test writes made outside the API also invalidate the ETag"""
+        response = client.get('/pets')
+        assert _j(response) == []
+        etag = response.headers['ETag']
+        
+        # Add a pet the way the Flask shell would
+        with app.app_context():
+            db.session.add(Pet(name='Fido', species='Dog'))
+            db.session.commit()
+        
+        response = client.get('/pets', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert _j(response)[0]['name'] == 'Fido'
 
 
 class TestPetUpdate:
@@ -176,10 +235,7 @@ class TestPetUpdate:
     def test_update_pet_success(self, client, sample_pets):
         """Test successful pet update"""
         # Create a pet first
-        create_response = client.post('/pets', 
-                                    json=sample_pets[0], 
-                                    content_type='application/json')
-        pet_id = json.loads(create_response.data)['id']
+        pet_id = _seed(sample_pets[:1])[0]
         
         # Update the pet
         update_data = {'name': 'Fido Updated', 'species': 'Big Dog'}
@@ -188,7 +244,7 @@ class TestPetUpdate:
                             content_type='application/json')
         
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = _j(response)
         assert data['name'] == 'Fido Updated'
         assert data['species'] == 'Big Dog'
         assert data['id'] == pet_id
@@ -196,10 +252,7 @@ class TestPetUpdate:
     def test_update_pet_partial(self, client, sample_pets):
         """Test partial pet update"""
         # Create a pet first
-        create_response = client.post('/pets', 
-                                    json=sample_pets[0], 
-                                    content_type='application/json')
-        pet_id = json.loads(create_response.data)['id']
+        pet_id = _seed(sample_pets[:1])[0]
         
         # Update only the name
         update_data = {'name': 'Fido the Great'}
@@ -208,10 +261,34 @@ class TestPetUpdate:
                               content_type='application/json')
         
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = _j(response)
         assert data['name'] == 'Fido the Great'
         assert data['species'] == 'Dog'  # species should remain unchanged
     
+    @pytest.mark.parametrize('update_data', [
+        pytest.param({'name': 'Fido', 'species': 'Dog'}, id='same-values'),
+        pytest.param({'foo': 1}, id='unrelated-keys'),
+    ])
+    def test_update_pet_no_changes(self, client, sample_pets, update_data):
+        """Test an update that changes nothing skips the commit"""
+        # Create a pet first
+        pet_id = _seed(sample_pets[:1])[0]
+        _db_state['dirty'] = False
+        
+        response = client.put(f'/pets/{pet_id}', 
+                            json=update_data,
+                            content_type='application/json')
+        committed = _db_state['dirty']
+        # the seeded pet still has to be cleaned up after the test
+        _db_state['dirty'] = True
+        
+        assert not committed
+        assert response.status_code == 200
+        data = _j(response)
+        assert data['name'] == 'Fido'
+        assert data['species'] == 'Dog'
+        assert data['id'] == pet_id
+    
     def test_update_pet_not_found(self, client):
         """Test updating a pet that doesn't exist"""
         response = client.put('/pets/999', 
@@ -219,9 +296,20 @@ class TestPetUpdate:
                             content_type='application/json')
         
         assert response.status_code == 404
-        data = json.loads(response.data)
+        data = _j(response)
         assert 'error' in data
         assert 'Pet not found' in data['error']
+    
+    @pytest.mark.parametrize('body', [b'null', b'"my name"', b'["name"]'])
+    def test_update_pet_body_not_object(self, client, body):
+        """Test updating a pet with a JSON body that isn't an object"""
+        response = client.put('/pets/999', 
+                            data=body,
+                            content_type='application/json')
+        
+        assert response.status_code == 400
+        data = _j(response)
+        assert 'Request body must be a JSON object' in data['error']
 
 
 class TestPetDeletion:
@@ -230,15 +318,12 @@ class TestPetDeletion:
     def test_delete_pet_success(self, client, sample_pets):
         """Test successful pet deletion"""
         # Create a pet first
-        create_response = client.post('/pets', 
-                                    json=sample_pets[0], 
-                                    content_type='application/json')
-        pet_id = json.loads(create_response.data)['id']
+        pet_id = _seed(sample_pets[:1])[0]
         
         # Delete the pet
         response = client.delete(f'/pets/{pet_id}')
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = _j(response)
         assert 'message' in data
         assert 'Pet deleted successfully' in data['message']
         
@@ -250,19 +335,18 @@ class TestPetDeletion:
         """Test deleting a pet that doesn't exist"""
         response = client.delete('/pets/999')
         assert response.status_code == 404
-        data = json.loads(response.data)
+        data = _j(response)
         assert 'error' in data
         assert 'Pet not found' in data['error']
     
     def test_delete_all_pets_via_query(self, client, sample_pets):
         """Test deleting all pets using query.delete()"""
         # Create multiple pets
-        for pet_data in sample_pets:
-            client.post('/pets', json=pet_data, content_type='application/json')
+        _seed(sample_pets)
         
         # Verify pets exist
         response = client.get('/pets')
-        assert len(json.loads(response.data)) == 3
+        assert len(_j(response)) == 3
         
         # Delete all pets (simulating Pet.query.delete())
         with app.app_context():
@@ -272,7 +356,7 @@ class TestPetDeletion:
         
         # Verify all pets are deleted
         response = client.get('/pets')
-        assert json.loads(response.data) == []
+        assert _j(response) == []
 
 
 class TestFlaskShellOperations:
@@ -380,6 +464,145 @@ class TestFlaskShellOperations:
             assert Pet.query.count() == 0
 
 
+class TestIndexes:
+    """Test indexes are added to databases created before they existed"""
+    
+    def test_ensure_indexes_on_existing_table(self):
+        """Test ensure_indexes adds the covering index to an old pets table"""
+        engine = create_engine('sqlite://')
+        try:
+            with engine.begin() as conn:
+                conn.execute(text('CREATE TABLE pets (id INTEGER PRIMARY KEY, '
+                                  'name VARCHAR, species VARCHAR)'))
+            
+            app_module.ensure_indexes(engine)
+            # running it again is a no-op
+            app_module.ensure_indexes(engine)
+            
+            indexes = inspect(engine).get_indexes('pets')
+            assert [index['name'] for index in indexes] == \
+                ['ix_pets_species_name']
+            with engine.connect() as conn:
+                plan = conn.execute(text(
+                    "EXPLAIN QUERY PLAN SELECT id, name, species FROM pets "
+                    "WHERE species = 'Cat'")).all()
+            assert 'COVERING INDEX ix_pets_species_name' in plan[0][-1]
+        finally:
+            engine.dispose()
+
+
+class TestReadOnlyEngine:
+    """Test the read-only engine used for file databases"""
+    
+    def test_read_engine_special_characters_in_path(self, tmp_path):
+        """Test reading a database whose path needs URI escaping"""
+        directory = tmp_path / 'rv#h?x%41'
+        directory.mkdir()
+        path = directory / 'app.db'
+        
+        # Create a file database with one pet in it
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE pets (id INTEGER PRIMARY KEY, '
+                     'name VARCHAR, species VARCHAR)')
+        conn.execute("INSERT INTO pets (name, species) VALUES ('Fido', 'Dog')")
+        conn.commit()
+        
+        engine = app_module.create_read_engine(str(path))
+        try:
+            with engine.connect() as read_conn:
+                rows = read_conn.execute(
+                    text('SELECT name, species FROM pets')).all()
+                assert [tuple(row) for row in rows] == [('Fido', 'Dog')]
+                
+                # Connections really are read-only
+                with pytest.raises(OperationalError):
+                    read_conn.execute(text('DELETE FROM pets'))
+        finally:
+            engine.dispose()
+            conn.close()
+    
+    def test_read_engine_more_connections_than_threads(self, tmp_path):
+        """Test the pool grows past SERVER_THREADS instead of blocking"""
+        path = tmp_path / 'app.db'
+        sqlite3.connect(path).close()
+        
+        engine = app_module.create_read_engine(str(path))
+        # fail fast instead of waiting 30 seconds if the pool is capped
+        engine.pool._timeout = 0.1
+        connections = []
+        try:
+            for _ in range(app_module.SERVER_THREADS * 2):
+                connections.append(engine.connect())
+            assert len(connections) == app_module.SERVER_THREADS * 2
+        finally:
+            for connection in connections:
+                connection.close()
+            engine.dispose()
+
+
+def _load_fastjson(monkeypatch, blocked):
+    """Import a fresh copy of fastjson with the given modules unavailable"""
+    for name in blocked:
+        monkeypatch.setitem(sys.modules, name, None)
+    spec = importlib.util.spec_from_file_location(
+        'fastjson_fallback', fastjson.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestFastJSON:
+    """Test the JSON fallbacks used when orjson is not installed"""
+    
+    @pytest.mark.parametrize('blocked', [
+        pytest.param(['orjson'], id='ujson'),
+        pytest.param(['orjson', 'ujson'], id='stdlib'),
+    ])
+    def test_fallback(self, monkeypatch, blocked):
+        """Test dumps and loads behave like orjson in each fallback"""
+        if 'ujson' not in blocked:
+            pytest.importorskip('ujson')
+        module = _load_fastjson(monkeypatch, blocked)
+        assert not hasattr(module, 'orjson')
+        
+        # dumps returns compact UTF-8 bytes
+        body = module.dumps({'name': 'Fido', 'species': 'Dög', 'ids': [1, 2]})
+        assert body == '{"name":"Fido","species":"Dög","ids":[1,2]}'.encode()
+        assert module.loads(body)['species'] == 'Dög'
+        
+        # invalid input raises ValueError, which get_json_body relies on
+        with pytest.raises(ValueError):
+            module.loads(b'')
+        with pytest.raises(ValueError):
+            module.loads(b'\xff')
+
+
+class TestMaintenance:
+    """Test background database maintenance"""
+    
+    def test_schedule_optimize_survives_errors(self, monkeypatch):
+        """Test a failed PRAGMA optimize still schedules the next run"""
+        started = []
+        
+        class FakeTimer:
+            def __init__(self, interval, function):
+                self.interval = interval
+            
+            def start(self):
+                started.append(self.interval)
+        
+        def locked():
+            raise OperationalError('PRAGMA optimize', {}, Exception('locked'))
+        
+        monkeypatch.setattr(app_module, 'optimize_database', locked)
+        monkeypatch.setattr(app_module.threading, 'Timer', FakeTimer)
+        
+        app_module.schedule_optimize()
+        
+        assert started == [app_module.OPTIMIZE_INTERVAL]
+
+
 # Keep the original test for compatibility
 def test_codegrade_placeholder():
     """Codegrade placeholder test"""